@@ -1,5 +1,9 @@
 import os
-from collections import OrderedDict
+import shutil
+import tempfile
+
+# 删除空白字符的转换表，只构建一次
+_WS_DELETE = str.maketrans({c: None for c in ' \t\r\n\v\f'})
 
 # 获取 zsh 历史文件路径
 def get_zsh_history_path():
@@ -7,34 +11,41 @@ def get_zsh_history_path():
 
 def normalize_command(cmd):
     # 去除空格并忽略大小写
-    return ''.join(cmd.split()).lower()
+    return cmd.translate(_WS_DELETE).lower()
 
 def remove_duplicate_history(history_path):
     if not os.path.exists(history_path):
         print(f"History file not found: {history_path}")
         return
-    unique = OrderedDict()
-    all_lines = []
-    with open(history_path, 'r', encoding='utf-8', errors='ignore') as f:
+    seen = set()
+    unique_lines = []
+    before_count = 0
+    # 以字节方式读写，原样保留非 UTF-8 字节；去重键用 surrogateescape 解码，非 ASCII 字符也能忽略大小写
+    with open(history_path, 'rb') as f:
         for line in f:
-            all_lines.append(line)
-            # zsh 历史格式可能有时间戳等，命令在最后
-            if ';' in line:
-                cmd = line.split(';', 1)[1].strip()  # 取第一个分号后的内容
-            else:
-                cmd = line.strip()
-            key = normalize_command(cmd)
-            if key not in unique:
-                unique[key] = line  # 保留原始行
-    before_count = len(all_lines)
-    after_count = len(unique)
+            before_count += 1
+            # zsh 历史格式可能有时间戳等，命令在第一个分号之后
+            key = normalize_command(line.split(b';', 1)[-1].decode('utf-8', 'surrogateescape'))
+            if key not in seen:
+                seen.add(key)
+                unique_lines.append(line)  # 保留原始行
+    after_count = len(unique_lines)
+    # 去重结果一次性写入同目录下的临时文件，落盘后原子替换
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(history_path), prefix='.zsh_history.')
+    try:
+        with open(fd, 'wb', buffering=1 << 20) as tmp:
+            tmp.writelines(unique_lines)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        # 备份原文件
+        backup_path = history_path + '.bak'
+        shutil.copy2(history_path, backup_path)
+        shutil.copymode(history_path, tmp_path)
+        os.replace(tmp_path, history_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
     cleared_count = before_count - after_count
-    # 备份原文件
-    backup_path = history_path + '.bak'
-    os.rename(history_path, backup_path)
-    with open(history_path, 'w', encoding='utf-8') as f:
-        for line in unique.values():
-            f.write(line)
     print(f"去重完成，原始文件已备份为: {backup_path}")
     print(f"去重前条目数: {before_count}")
     print(f"去重后条目数: {after_count}")
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""基于 PyNvVideoCodec 的 NVDEC/NVENC 编码后端
+
+解码得到的帧直接留在显存中送入编码器，不经过 ffmpeg 的滤镜链；
+编码只产出 HEVC 裸流，音频等其他轨道最后用一次 ffmpeg -c copy 复用回去。
+"""
+
+import subprocess
+from pathlib import Path
+
+# 可选依赖: PyNvVideoCodec 仅在安装了 NVIDIA 驱动和 CUDA 的机器上可用
+try:
+    import PyNvVideoCodec as nvc
+    HAS_PYNVC = True
+except ImportError:
+    nvc = None
+    HAS_PYNVC = False
+
+
+def _encode_stream(video_path, stream_path, bitrate):
+    """GPU 解码 + 编码，写出 HEVC 裸流，返回帧率"""
+    demuxer = nvc.CreateDemuxer(filename=str(video_path))
+    decoder = nvc.CreateDecoder(gpuid=0, codec=demuxer.GetNvCodecId(),
+                                cudacontext=0, cudastream=0, usedevicememory=True)
+    encoder = nvc.CreateEncoder(demuxer.Width(), demuxer.Height(), "NV12", False,
+                                codec="hevc", bitrate=int(bitrate))
+    with open(stream_path, "wb") as f:
+        for packet in demuxer:
+            for surface in decoder.Decode(packet):
+                f.write(bytearray(encoder.Encode(surface)))
+        f.write(bytearray(encoder.EndEncode()))
+    return demuxer.FrameRate()
+
+
+def encode(video_path, out_path, bitrate, ffmpeg_cmd="ffmpeg"):
+    """把 video_path 编码为 HEVC 写入 out_path，bitrate 单位为 bit/s"""
+    out_path = Path(out_path)
+    stream_path = out_path.with_name(f"{out_path.stem}.hevc")
+    try:
+        fps = _encode_stream(video_path, stream_path, bitrate)
+        # 视频取新编码的裸流，其余轨道 (音频、字幕) 从原文件原样复制
+        cmd = [ffmpeg_cmd, "-y", "-hide_banner",
+               "-framerate", str(fps), "-i", str(stream_path),
+               "-i", str(video_path),
+               "-map", "0:v:0", "-map", "1", "-map", "-1:v",
+               "-c", "copy", "-tag:v", "hvc1", str(out_path)]
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       text=True, check=True)
+    finally:
+        if stream_path.exists():
+            stream_path.unlink()
@@ -1,36 +1,54 @@
 #!/usr/bin/env python3
 import os
 import argparse
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from media_process import format_size
+
+# 并发删除的线程数：unlink 期间会释放 GIL，高延迟文件系统上多线程可接近线性加速
+DELETE_WORKERS = 32
+
+def _walk(directory, extensions):
+    """用 os.scandir 递归遍历目录，产出扩展名匹配的文件 DirEntry"""
+    try:
+        it = os.scandir(directory)
+    except OSError:
+        # 与 os.walk 一样跳过无权限或已消失的目录
+        return
+    with it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk(entry.path, extensions)
+            elif entry.is_file() and entry.name.lower().endswith(extensions):
+                yield entry
+
+def _unlink_one(item):
+    """删除单个文件，返回 (路径, 大小, 错误或None)"""
+    file_path, file_size = item
+    try:
+        os.unlink(file_path)  # 删除文件
+        return file_path, file_size, None
+    except Exception as e:
+        return file_path, file_size, e
 
 def delete_videos(directory, extensions=('.mp4', '.mov', '.avi', '.mkv', '.webm', '.flv', '.m4v')):
     """删除指定目录及其子目录中的所有视频文件"""
     deleted_files = []
     total_size = 0
     
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.lower().endswith(extensions):
-                file_path = Path(root) / file
-                file_size = file_path.stat().st_size
-                try:
-                    file_path.unlink()  # 删除文件
-                    deleted_files.append(str(file_path))
-                    total_size += file_size
-                    print(f"已删除: {file_path}")
-                except Exception as e:
-                    print(f"删除失败 {file_path}: {e}")
+    # 先收集待删除文件，再交给线程池并发删除
+    targets = [(entry.path, entry.stat().st_size) for entry in _walk(directory, extensions)]
+    
+    with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+        for file_path, file_size, error in executor.map(_unlink_one, targets):
+            if error is None:
+                deleted_files.append(file_path)
+                total_size += file_size
+            else:
+                print(f"删除失败 {file_path}: {error}")
     
     return deleted_files, total_size
 
-def format_size(size):
-    """格式化文件大小"""
-    for unit in ["B", "KB", "MB", "GB"]:
-        if size < 1024:
-            return f"{size:.2f} {unit}"
-        size /= 1024
-    return f"{size:.2f} TB"
-
 def main():
     parser = argparse.ArgumentParser(description='删除指定目录中的所有视频文件')
     parser.add_argument('directory', help='要处理的目录路径')
@@ -11,6 +11,10 @@ from pathlib import Path
 import time
 import uuid
 import os
+import shlex
+import shutil
+import sqlite3
+import multiprocessing
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 sys.path.append(parent_dir)
@@ -20,94 +24,242 @@ from media_process import (
     MediaProcessor,  calc_save_space
 )
 
+# 可选依赖: Pillow (带 libwebp) 可在进程内编码，省去每张图一次 cwebp 的 fork+exec
+try:
+    from PIL import Image, features
+    HAS_PIL_WEBP = features.check("webp")
+except ImportError:
+    Image = None
+    HAS_PIL_WEBP = False
 
+# 可选依赖: pillow-heif 为 Pillow 注册 HEIC/HEIF 解码器，cwebp 无法直接读取这两种格式
+HEIF_SUFFIXES = (".heic", ".heif")
+try:
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+    HAS_HEIF = HAS_PIL_WEBP
+except ImportError:
+    HAS_HEIF = False
 
+# 小于该大小 (字节) 的图片直接复制，调用 cwebp 的开销超过可能节省的空间
+DEFAULT_MIN_SIZE = 8 * 1024
+# 使用 cwebp 时每个子进程批量处理的图片数
+CWEBP_BATCH_SIZE = 16
+# cwebp 可执行文件路径，工作进程启动时由 _worker_init 解析为绝对路径
+CWEBP_PATH = "cwebp"
+# 输出目录中的转换结果缓存文件，以及每累计多少条结果提交一次
+CACHE_FILE_NAME = ".img2webp.cache"
+CACHE_COMMIT_INTERVAL = 100
 
 
-def process_image(args):
-    """处理单个图像的独立函数（供多进程调用）"""
-    img_path, input_base_dir, output_base_dir, quality = args
+def _worker_init():
+    """工作进程初始化: 预先解析cwebp的绝对路径，避免每次调用都查找 $PATH"""
+    global CWEBP_PATH
+    CWEBP_PATH = shutil.which("cwebp") or "cwebp"
+
+def cwebp_command(img_path, output_file, quality):
+    """构建cwebp命令行"""
+    return [
+        CWEBP_PATH,
+        "-q", str(quality),
+        "-mt",
+        "-m", "6",
+        str(img_path),
+        "-o", str(output_file)
+    ]
+
+def is_heif(img_path):
+    """是否为 HEIC/HEIF 图像"""
+    return str(img_path).lower().endswith(HEIF_SUFFIXES)
+
+def encode_webp(img_path, output_file, quality):
+    """将图像编码为WebP: 优先使用Pillow进程内编码，不可用时回退到cwebp (HEIC/HEIF 只能用Pillow)"""
+    if is_heif(img_path) and not HAS_HEIF:
+        raise RuntimeError("转换 HEIC/HEIF 需要安装 pillow-heif 及带 WebP 支持的 Pillow")
+    if HAS_PIL_WEBP:
+        with Image.open(img_path) as im:
+            if im.mode not in ("RGB", "RGBA"):
+                im = im.convert("RGBA" if "A" in im.mode or "transparency" in im.info else "RGB")
+            im.save(output_file, "WEBP", quality=quality, method=6)
+        return
+    
+    subprocess.run(cwebp_command(img_path, output_file, quality), check=True,
+                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def prepare_image(args):
+    """准备单个图像的输出路径
+    
+    已存在或直接复制的文件返回 (结果, None)，需要编码的文件返回 (None, 编码任务)
+    """
+    # 热路径中路径均为字符串，使用 os.path 而非 Path 以减少对象分配
+    img_path, input_base_dir, output_base_dir, quality, min_size, input_size = args
     
     # 计算相对路径
-    rel_path = img_path.relative_to(input_base_dir)
+    rel_path = os.path.relpath(img_path, input_base_dir)
     # 计算输出目录
-    output_dir = output_base_dir / rel_path.parent
-    output_dir.mkdir(parents=True, exist_ok=True)
-    # 计算输出文件路径
-    output_path = output_dir / f"{img_path.stem}.webp"
+    output_dir = os.path.join(output_base_dir, os.path.dirname(rel_path))
+    os.makedirs(output_dir, exist_ok=True)
+    # 父进程已 stat 过原图时直接复用其大小，否则只 stat 一次，后续统计复用该大小
+    if input_size is None:
+        input_size = os.stat(img_path).st_size
+    # 小图不转换，按原文件名复制；否则输出为 .webp
+    copy_only = input_size < min_size
+    name = os.path.basename(img_path)
+    stem = os.path.splitext(name)[0]
+    output_path = os.path.join(output_dir, name if copy_only else f"{stem}.webp")
     
     # 检查目标文件是否已经存在
-    if output_path.exists():
-        stats = calc_save_space(img_path, output_path)
+    if os.path.exists(output_path):
+        stats = calc_save_space(img_path, output_path, input_size)
         return (True, {
             "message": f"{stats['formatted_text']} (已存在，跳过) ",
             **stats
-        })
+        }), None
+    
+    if copy_only:
+        try:
+            shutil.copy2(img_path, output_path)
+        except OSError as e:
+            return (False, {
+                "message": f"{rel_path} (error: {str(e)})"
+            }), None
+        stats = calc_save_space(img_path, output_path, input_size)
+        return (True, {
+            "message": f"{rel_path} {stats['formatted_text']} (小于 {min_size} 字节，直接复制)",
+            **stats
+        }), None
     
     # 创建临时文件路径
-    temp_file = output_dir / f"{img_path.stem}.webp.tmp"
-    if temp_file.exists():
-        temp_file.unlink()
+    temp_file = os.path.join(output_dir, f"{stem}.webp.tmp")
+    if os.path.exists(temp_file):
+        os.unlink(temp_file)
     
-    cmd = [
-        "cwebp",
-        "-q", str(quality),
-        "-mt",
-        "-m", "6",
-        str(img_path),
-        "-o", str(temp_file)
-    ]
+    return None, (img_path, rel_path, output_path, temp_file, input_size, quality)
+
+def finish_image(job, error=None):
+    """编码结束后移动临时文件并统计结果，error 为编码过程中的异常"""
+    img_path, rel_path, output_path, temp_file, input_size, _ = job
     
-    try:
-        subprocess.run(cmd, check=True,
-                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        
-        # 压缩成功后，将临时文件移动到最终位置
-        # 再次检查目标文件是否存在，避免多进程竞争条件
-        if output_path.exists():
-            temp_file.unlink()  # 删除临时文件
-            stats = calc_save_space(img_path, output_path)
+    if error is None:
+        try:
+            # 压缩成功后，将临时文件移动到最终位置
+            # 临时文件与目标文件位于同一目录，os.replace 是单次原子重命名
+            os.replace(temp_file, output_path)
+            
+            # 打印处理前后的文件大小, 以及节省的空间
+            stats = calc_save_space(img_path, output_path, input_size)
             return True, {
-                "message": f"{stats['formatted_text']}  (另一进程已处理) ",
+                "message": f"{rel_path} {stats['formatted_text']}",
                 **stats
             }
-            
-        # 安全移动临时文件到最终位置
-        import shutil
-        shutil.move(str(temp_file), str(output_path))
-        
-        # 打印处理前后的文件大小, 以及节省的空间
-        stats = calc_save_space(img_path, output_path)
-        return True, {
-            "message": f"{rel_path} {stats['formatted_text']}",
-            **stats
-        }
-    except subprocess.CalledProcessError as e:
-        # 出错时删除临时文件（如果存在）
-        if temp_file.exists():
-            temp_file.unlink()
+        except Exception as e:
+            error = e
+    
+    # 出错时删除临时文件（如果存在）
+    if os.path.exists(temp_file):
+        os.unlink(temp_file)
+    if isinstance(error, subprocess.CalledProcessError):
         return False, {
-            "message": f"{rel_path} (error code {e.returncode})",
+            "message": f"{rel_path} (error code {error.returncode})",
         }
+    return False, {
+        "message": f"{rel_path} (error: {str(error)})"
+    }
+
+def encode_image(job):
+    """编码单个待处理图像并返回结果"""
+    img_path, _, _, temp_file, _, quality = job
+    try:
+        encode_webp(img_path, temp_file, quality)
     except Exception as e:
-        # 处理其他可能的错误
-        if temp_file.exists():
-            temp_file.unlink()
-            
-        return False, {
-            "message": f"{rel_path} (error: {str(e)})"
-        }
+        return finish_image(job, e)
+    return finish_image(job)
+
+def process_image(args):
+    """处理单个图像的独立函数（供多进程调用）"""
+    result, job = prepare_image(args)
+    if result is not None:
+        return result
+    return encode_image(job)
+
+def process_image_batch(batch):
+    """批量处理图像（供多进程调用）：需要编码的文件共用一次 sh 调用依次执行 cwebp
+    
+    返回每个文件的 (status, stats) 列表
+    """
+    results = []
+    jobs = []
+    for args in batch:
+        result, job = prepare_image(args)
+        if result is not None:
+            results.append(result)
+        elif is_heif(job[0]):
+            # HEIC/HEIF 不经过 cwebp，单独在进程内编码
+            results.append(encode_image(job))
+        else:
+            jobs.append(job)
+    
+    if not jobs:
+        return results
+    
+    # 每条 cwebp 命令后输出其退出码，按行对应到各个文件
+    cmds = [cwebp_command(img_path, temp_file, quality)
+            for img_path, _, _, temp_file, _, quality in jobs]
+    script = "\n".join(f"{shlex.join(cmd)} >/dev/null 2>&1; echo $?" for cmd in cmds)
+    try:
+        process = subprocess.run(["sh", "-c", script], check=True,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        return_codes = process.stdout.split()
+    except Exception as e:
+        results.extend(finish_image(job, e) for job in jobs)
+        return results
+    
+    for i, (job, cmd) in enumerate(zip(jobs, cmds)):
+        code = int(return_codes[i]) if i < len(return_codes) else -1
+        if code == 0:
+            results.append(finish_image(job))
+        else:
+            results.append(finish_image(job, subprocess.CalledProcessError(code, cmd)))
+    return results
 
 class WebpConverter(MediaProcessor):
     """WebP图像转换器类"""
     
-    def __init__(self, input_dir, quality=85, workers=None):
-        super().__init__(input_dir, workers)
+    parent_only_attrs = MediaProcessor.parent_only_attrs + ('cache_db', 'input_stats')
+    # 图片通常较小，预读可在编码的同时隐藏磁盘延迟
+    prefetch_inputs = True
+    # 工作进程只负责调用 cwebp/Pillow，由 forkserver 预先导入模块后 fork，不复制父进程的内存
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else None
+    forkserver_preload = ("__main__", "subprocess", "pathlib", "utils.logger", "media_process")
+    
+    def __init__(self, input_dir, quality=85, workers=None, min_size=DEFAULT_MIN_SIZE, verbose=False):
+        super().__init__(input_dir, workers, verbose=verbose)
         self.quality = quality
-        self.supported_formats = (".jpg", ".jpeg", ".png","heic", ".heif")
+        self.min_size = min_size
+        # Pillow 进程内编码无需批量；cwebp 按批调用以摊薄 fork+exec 开销
+        self.batch_size = 1 if HAS_PIL_WEBP else CWEBP_BATCH_SIZE
+        # 转换结果缓存: 输入文件的 mtime、大小和转换参数不变且输出文件仍存在时直接复用上次结果
+        self.cache_db = sqlite3.connect(self.directory_processor.output_base_dir / CACHE_FILE_NAME)
+        columns = {row[1] for row in self.cache_db.execute("PRAGMA table_info(results)")}
+        if columns and "output_path" not in columns:
+            # 旧版本的缓存没有记录输出路径和转换参数，直接丢弃
+            self.cache_db.execute("DROP TABLE results")
+        self.cache_db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "input_path TEXT PRIMARY KEY, input_mtime INT, input_size INT, output_size INT, "
+            "output_path TEXT, quality INT, min_size INT)"
+        )
+        self.input_stats = {}
+        self.uncommitted = 0
+        self.supported_formats = frozenset({".jpg", ".jpeg", ".png", ".heic", ".heif"})
     
     def check_dependencies(self):
-        """检查cwebp工具是否已安装"""
+        """检查Pillow (带WebP支持) 或cwebp工具是否可用"""
+        if not HAS_HEIF:
+            logI("提示: 未安装 pillow-heif (pip install pillow-heif)，HEIC/HEIF 图片将无法转换")
+        if HAS_PIL_WEBP:
+            logI("使用 Pillow 进程内编码 WebP")
+            return True
         try:
             subprocess.run(["cwebp", "-version"], check=True, 
                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
@@ -115,19 +267,81 @@ class WebpConverter(MediaProcessor):
         except (subprocess.CalledProcessError, FileNotFoundError):
             logI("Error: cwebp not found. Please install WebP tools first.")
             logI("Installation options:")
+            logI("  pip install Pillow")
             logI("  macOS: brew install webp")
             logI("  Linux: sudo apt-get install webp")
             return False
     
     def create_tasks(self, files):
-        """创建处理任务列表"""
-        return [
-            (img, self.directory_processor.input_base_dir, self.directory_processor.output_base_dir, self.quality) 
-            for img in files
+        """创建处理任务列表 (使用cwebp时按 batch_size 分批，路径以字符串传递以减小序列化开销)"""
+        input_base_dir = str(self.directory_processor.input_base_dir)
+        output_base_dir = str(self.directory_processor.output_base_dir)
+        tasks = [
+            (img, input_base_dir, output_base_dir,
+             self.quality, self.min_size, self.input_stats.get(img, (None, None))[1]) 
+            for img in map(str, files)
         ]
+        if self.batch_size > 1:
+            return [tasks[i:i + self.batch_size] for i in range(0, len(tasks), self.batch_size)]
+        return tasks
+    
+    def init_worker(self):
+        """工作进程初始化"""
+        _worker_init()
+    
+    def split_cached_files(self, files):
+        """根据缓存拆分文件: mtime、大小和转换参数未变且输出仍存在的文件直接返回上次的结果"""
+        cached_results = []
+        pending_files = []
+        for img in files:
+            key = str(img)
+            st = os.stat(key)
+            row = self.cache_db.execute(
+                "SELECT input_mtime, input_size, output_size, output_path, quality, min_size "
+                "FROM results WHERE input_path = ?", (key,)
+            ).fetchone()
+            if (row and row[:2] == (st.st_mtime_ns, st.st_size) and row[4:] == (self.quality, self.min_size)
+                    and os.path.exists(row[3])):
+                stats = calc_save_space(key, None, row[1], row[2])
+                cached_results.append((True, {
+                    "message": f"{stats['formatted_text']} (缓存命中，跳过) ",
+                    **stats
+                }))
+            else:
+                self.input_stats[key] = (st.st_mtime_ns, st.st_size)
+                pending_files.append(img)
+        return cached_results, pending_files
+    
+    def on_file_processed(self, status, stats):
+        """记录成功的转换结果到缓存，按批提交"""
+        if not status:
+            return
+        key = str(stats['origin_file'])
+        input_mtime, input_size = self.input_stats.pop(key, (None, None))
+        if input_mtime is None:
+            return
+        self.cache_db.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, input_mtime, input_size, stats['processed_size'], str(stats['output_file']),
+             self.quality, self.min_size)
+        )
+        self.uncommitted += 1
+        if self.uncommitted >= CACHE_COMMIT_INTERVAL:
+            self.cache_db.commit()
+            self.uncommitted = 0
+    
+    def process(self):
+        """开始处理过程，结束时提交并关闭缓存"""
+        try:
+            return super().process()
+        finally:
+            self.cache_db.commit()
+            self.cache_db.close()
     
     def process_file(self, args):
-        """处理单个文件"""
+        """处理单个文件或一批文件"""
+        if self.batch_size > 1:
+            return process_image_batch(args)
         return process_image(args)
 
 
@@ -141,6 +355,10 @@ def main():
                       help="Show local progress for each directory (default: global progress)")
     parser.add_argument("-w", "--workers", type=int,
                       help="Number of worker processes (default: CPU count + 1)")
+    parser.add_argument("-m", "--min-size", type=int, default=DEFAULT_MIN_SIZE,
+                      help=f"Copy images smaller than this many bytes instead of converting (default: {DEFAULT_MIN_SIZE})")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                      help="Log every processed file (default: throttle progress lines)")
     
     args = parser.parse_args()
     
@@ -162,7 +380,9 @@ def main():
         converter = WebpConverter(
             input_dir=args.input_dir, 
             quality=args.quality, 
-            workers=args.workers
+            workers=args.workers,
+            min_size=args.min_size,
+            verbose=args.verbose
         )
         
         success = converter.process()
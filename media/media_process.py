@@ -7,24 +7,33 @@ import sys
 from pathlib import Path
 import time
 import logging
-from multiprocessing import Pool, Lock, Manager
+import multiprocessing
+from multiprocessing import Lock
+from multiprocessing.pool import ThreadPool
 from abc import ABC, abstractmethod
 import uuid
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 sys.path.append(parent_dir)
-from utils.logger import setup_logging, logI
+from utils.logger import setup_logging, setup_queue_logging, get_log_queue, logI
 
 compressed_identifier = "_compressed"
+# 预读线程最多领先已完成结果的文件数，避免页缓存被挤占
+PREFETCH_AHEAD = 32
+# 父进程中执行轻量任务 (如直接复制) 的线程数
+LOCAL_TASK_WORKERS = 8
+# 非详细模式下两次进度输出的最小间隔 (秒)
+PROGRESS_LOG_INTERVAL = 0.1
+
+SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
 
 def format_size(size):
-    """格式化文件大小"""
-    for unit in ["B", "KB", "MB", "GB"]:
-        if size < 1024:
-            return f"{size:.2f} {unit}"
-        size /= 1024
-    return f"{size:.2f} TB"
+    """格式化文件大小 (按整数位长度直接选择单位，无需循环除法)"""
+    unit = min(len(SIZE_UNITS) - 1, max(0, (int(abs(size)).bit_length() - 1) // 10))
+    return f"{size / (1 << (10 * unit)):.2f} {SIZE_UNITS[unit]}"
 
 def calculate_dir_size(directory):
     """计算目录大小"""
@@ -34,14 +43,20 @@ def calculate_dir_size(directory):
             total_size += path.stat().st_size
     return total_size
 
-def calc_save_space(input_file, output_file):
-    """计算节省的空间并返回格式化输出和原始数据"""
-    original_size = input_file.stat().st_size
-    output_size = output_file.stat().st_size
+def calc_save_space(input_file, output_file, original_size=None, output_size=None):
+    """计算节省的空间并返回格式化输出和原始数据
+    
+    文件可为 Path 或字符串路径，可传入已获取的文件大小以省去 stat
+    """
+    if original_size is None:
+        original_size = os.stat(input_file).st_size
+    if output_size is None:
+        output_size = os.stat(output_file).st_size
     saved_space = original_size - output_size
-    formatted_text = f"({input_file.name}  {format_size(original_size)} -> {format_size(output_size)}) 节省 {format_size(saved_space)}"
+    formatted_text = f"({os.path.basename(input_file)}  {format_size(original_size)} -> {format_size(output_size)}) 节省 {format_size(saved_space)}"
     stats = {
         'origin_file': input_file,
+        'output_file': output_file,
         'original_size': original_size,
         'processed_size': output_size,
         'saved_size': saved_space,
@@ -50,6 +65,51 @@ def calc_save_space(input_file, output_file):
     
     return  stats
 
+def prefetch_file(path):
+    """提示内核将文件预读到页缓存 (不支持 posix_fadvise 的平台上读取首字节)"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            os.read(fd, 1)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class InputPrefetcher:
+    """后台线程按派发顺序预读输入文件，使工作进程读取时文件已在页缓存中"""
+    
+    def __init__(self, files, ahead=PREFETCH_AHEAD):
+        self.files = files
+        self.slots = threading.Semaphore(ahead)
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+    
+    def _run(self):
+        for path in self.files:
+            self.slots.acquire()
+            if self.stopped:
+                return
+            prefetch_file(path)
+    
+    def start(self):
+        """开始预读"""
+        self.thread.start()
+    
+    def advance(self):
+        """一个文件处理完成，允许再预读一个文件"""
+        self.slots.release()
+    
+    def stop(self):
+        """停止预读"""
+        self.stopped = True
+        self.slots.release()
+
 class ProgressTracker(ABC):
     """进度跟踪的抽象基类(接口)"""
     
@@ -116,14 +176,14 @@ class ProgressTracker(ABC):
 class GlobalProgressTracker(ProgressTracker):
     """全局进度跟踪器 - 计算所有目录的总进度"""
     
-    def __init__(self, total_files):
+    def __init__(self, total_files, verbose=False):
         self.total_files = total_files
-        # 使用Manager创建可在进程间共享的对象
-        manager = Manager()
-        self.shared_dict = manager.dict()
-        self.shared_dict['processed'] = 0
-        self.shared_dict['success'] = 0
-        self.lock = manager.Lock()  # 使用manager创建的锁
+        # 详细模式逐个文件输出；否则成功的文件按时间间隔合并输出，失败的文件总是输出
+        self.verbose = verbose
+        self.last_log_time = 0.0
+        # 只有父进程在消费 imap_unordered 结果时更新进度，普通整数即可，无需加锁
+        self.processed = 0
+        self.success = 0
     
     def start_directory(self, dir_path, relative_path, total_files):
         """开始处理一个目录"""
@@ -132,15 +192,20 @@ class GlobalProgressTracker(ProgressTracker):
     
     def update(self, status:bool,stats:object):
         """更新进度"""
-        with self.lock:
-            self.shared_dict['processed'] += 1
-            percentage = (self.shared_dict['processed'] / self.total_files) * 100
-            
-            if status:
-                self.shared_dict['success'] += 1
-                logI(f"✓ {stats['message']} - 全局进度: {self.shared_dict['processed']}/{self.total_files} ({percentage:.1f}%)", flush=True)
-            else:
-                logI(f"✗ {stats['message']} - 全局进度: {self.shared_dict['processed']}/{self.total_files} ({percentage:.1f}%)", flush=True)
+        self.processed += 1
+        if status:
+            self.success += 1
+            now = time.monotonic()
+            if not self.verbose and now - self.last_log_time < PROGRESS_LOG_INTERVAL \
+                    and self.processed < self.total_files:
+                return
+            self.last_log_time = now
+        
+        percentage = (self.processed / self.total_files) * 100
+        if status:
+            logI(f"✓ {stats['message']} - 全局进度: {self.processed}/{self.total_files} ({percentage:.1f}%)")
+        else:
+            logI(f"✗ {stats['message']} - 全局进度: {self.processed}/{self.total_files} ({percentage:.1f}%)")
     
     def finish_directory(self):
         """完成一个目录的处理 (对于全局模式，不需要额外操作)"""
@@ -148,9 +213,8 @@ class GlobalProgressTracker(ProgressTracker):
     
     def finish_all(self):
         """完成所有处理"""
-        with self.lock:
-            success_percentage = (self.shared_dict['success'] / self.total_files) * 100
-            logI(f"\n全部处理完成: {self.shared_dict['success']}/{self.total_files} 成功 ({success_percentage:.1f}%)")
+        success_percentage = (self.success / self.total_files) * 100
+        logI(f"\n全部处理完成: {self.success}/{self.total_files} 成功 ({success_percentage:.1f}%)", flush=True)
 
 class DirectoryProcessor:
     """处理目录和文件收集的类"""
@@ -162,73 +226,57 @@ class DirectoryProcessor:
         # 添加需要跳过的文件夹和文件模式
         self.skip_dir_patterns = ["@*", ".*"]  # 跳过@开头和.开头的文件夹
         self.skip_file_patterns = [".*"]  # 跳过.开头的文件
+        self._skip_dir_compiled = self._compile_skip_patterns(self.skip_dir_patterns)
+        self._skip_file_compiled = self._compile_skip_patterns(self.skip_file_patterns)
         # 统计信息
         self.skipped_dirs = []
         self.skipped_files = []
     
-    def should_skip_dir(self, dir_path):
+    @staticmethod
+    def _compile_skip_patterns(patterns):
+        """将跳过模式预解析为 (前缀元组, 后缀元组, 精确匹配集合)"""
+        prefixes = tuple(p[:-1] for p in patterns if p.endswith("*"))
+        suffixes = tuple(p[1:] for p in patterns if p.startswith("*"))
+        exact = frozenset(p for p in patterns if "*" not in p)
+        return prefixes, suffixes, exact
+    
+    @staticmethod
+    def _match_skip(name, compiled):
+        """检查名称是否匹配预解析的跳过模式"""
+        prefixes, suffixes, exact = compiled
+        return name.startswith(prefixes) or name.endswith(suffixes) or name in exact
+    
+    def should_skip_dir(self, dir_name):
         """检查是否应该跳过该目录"""
-        dir_name = dir_path.name
-        for pattern in self.skip_dir_patterns:
-            if pattern.endswith("*") and dir_name.startswith(pattern[:-1]):
-                self.skipped_dirs.append(dir_path)
-                return True
-            elif pattern.startswith("*") and dir_name.endswith(pattern[1:]):
-                self.skipped_dirs.append(dir_path)
-                return True
-            elif pattern == dir_name:
-                self.skipped_dirs.append(dir_path)
-                return True
-        return False
-    
-    def should_skip_file(self, file_path):
+        return self._match_skip(dir_name, self._skip_dir_compiled)
+    
+    def should_skip_file(self, file_name):
         """检查是否应该跳过该文件"""
-        file_name = file_path.name
-        for pattern in self.skip_file_patterns:
-            if pattern.endswith("*") and file_name.startswith(pattern[:-1]):
-                self.skipped_files.append(file_path)
-                return True
-            elif pattern.startswith("*") and file_name.endswith(pattern[1:]):
-                self.skipped_files.append(file_path)
-                return True
-            elif pattern == file_name:
-                self.skipped_files.append(file_path)
-                return True
-        return False
+        return self._match_skip(file_name, self._skip_file_compiled)
     
     def collect_all_files(self, supported_formats):
-        """递归收集所有支持格式的文件"""
+        """收集所有支持格式的文件 (os.scandir 迭代遍历，避免逐项 stat)"""
         files = []
+        stack = [str(self.input_base_dir)]
         
-        def _collect(input_dir):
-            input_path = Path(input_dir)
-            for item in input_path.iterdir():
-                if item.is_file() and item.suffix.lower() in supported_formats:
-                    if not self.should_skip_file(item):
-                        files.append(item)
-                elif item.is_dir():
-                    if not self.should_skip_dir(item):
-                        _collect(item)
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_file(follow_symlinks=False):
+                        if os.path.splitext(entry.name)[1].lower() not in supported_formats:
+                            continue
+                        if self.should_skip_file(entry.name):
+                            self.skipped_files.append(Path(entry.path))
+                        else:
+                            files.append(Path(entry.path))
+                    elif entry.is_dir(follow_symlinks=False):
+                        if self.should_skip_dir(entry.name):
+                            self.skipped_dirs.append(Path(entry.path))
+                        else:
+                            stack.append(entry.path)
         
-        _collect(self.input_base_dir)
         return files
     
-    def collect_current_dir_files(self, input_dir, supported_formats):
-        """收集当前目录下的支持格式文件和子目录"""
-        input_path = Path(input_dir)
-        current_dir_files = []
-        subdirs = []
-        
-        for item in input_path.iterdir():
-            if item.is_file() and item.suffix.lower() in supported_formats:
-                if not self.should_skip_file(item):
-                    current_dir_files.append(item)
-            elif item.is_dir():
-                if not self.should_skip_dir(item):
-                    subdirs.append(item)
-        
-        return current_dir_files, subdirs
-    
     def logI_skip_stats(self):
         """打印跳过的文件和文件夹统计信息"""
         if self.skipped_dirs:
@@ -245,54 +293,172 @@ class DirectoryProcessor:
             if len(self.skipped_files) > 10:
                 logI(f"  ... 以及其他 {len(self.skipped_files) - 10} 个文件")
 
+def _init_pool_worker(processor, log_queue):
+    """进程池工作进程初始化: 日志改为发送到父进程的进程间队列"""
+    if log_queue is not None:
+        setup_queue_logging(log_queue)
+    processor.init_worker()
+
 class MediaProcessor:
     """多媒体处理器基类"""
     
-    def __init__(self, input_dir, workers=None,output_suffix=compressed_identifier):
+    # 只在父进程中使用、不传给工作进程的属性
+    parent_only_attrs = ('stats', 'progress_tracker', '_dir_progress')
+    # 是否在派发任务时预读输入文件 (适合大量小文件，子类可开启)
+    prefetch_inputs = False
+    # 是否用父进程内的线程池代替进程池 (任务主要在等待外部命令时开启，省去 fork、序列化和子进程初始化)
+    use_thread_pool = False
+    # 进程池的启动方式 (None 为平台默认)，以及 forkserver 预先导入的模块
+    start_method = None
+    forkserver_preload = ()
+    
+    def __init__(self, input_dir, workers=None,output_suffix=compressed_identifier, verbose=False):
         self.input_dir = input_dir
+        self.verbose = verbose
         self.workers = workers if workers else max(3, os.cpu_count()+1)
         self.directory_processor = DirectoryProcessor(input_dir, output_suffix)
-        self.supported_formats = ()  # 子类应覆盖此属性
-    
-    def _process_directory(self, input_dir):
-        """处理单个目录中的文件，然后递归处理子目录"""
-        input_path = Path(input_dir)
-        current_dir_files, subdirs = self.directory_processor.collect_current_dir_files(
-            input_dir, self.supported_formats
-        )
+        self.supported_formats = frozenset()  # 子类应覆盖此属性 (小写扩展名集合，按扩展名 O(1) 过滤)
+    
+    def _process_directories(self, pool, all_files):
+        """把所有目录的文件一次性派发到同一个进程池
         
-        # 处理当前目录下的文件
-        if current_dir_files:
-            # 计算相对路径用于显示
-            relative_path = input_path.relative_to(self.directory_processor.input_base_dir) \
-                if input_path != self.directory_processor.input_base_dir else Path('.')
-            
-            # 通知进度跟踪器开始处理新目录
-            self.progress_tracker.start_directory(
-                input_path, 
-                relative_path, 
-                len(current_dir_files)
-            )
-            
+        任务仍按目录分组创建 (缓存拆分、批量等钩子按目录调用)，但所有目录的任务合并为一次
+        imap_unordered，目录之间没有等待；目录的开始/完成根据已返回的结果数输出
+        """
+        base_dir = self.directory_processor.input_base_dir
+        groups = {}
+        for path in all_files:
+            groups.setdefault(path.parent, []).append(path)
+        
+        # 目录 -> [相对路径, 文件总数, 未完成文件数]
+        self._dir_progress = {
+            input_path: [input_path.relative_to(base_dir) if input_path != base_dir else Path('.'),
+                         len(files), len(files)]
+            for input_path, files in groups.items()
+        }
+        
+        pending_groups = {}
+        pending_all = []
+        for input_path, files in groups.items():
+            # 已有缓存结果的文件不再派发给工作进程
+            cached_results, pending_files = self.split_cached_files(files)
+            for status, stats in cached_results:
+                self._record_result(status, stats, input_path)
+            pending_groups[input_path] = pending_files
+            pending_all.extend(pending_files)
+        # 所有目录的待处理文件一起准备一次 (例如批量探测元数据)，再按目录创建任务
+        self.prepare_files(pending_all)
+        
+        pool_tasks = []
+        pool_task_dirs = []
+        local_tasks = []
+        for input_path, pending_files in pending_groups.items():
             # 处理文件 - 使用子类中定义的处理方法
-            with Pool(processes=self.workers) as pool:
-                tasks = self.create_tasks(current_dir_files)
-                
-                for status, stats  in pool.imap_unordered(self.process_file, tasks):
-                    self.progress_tracker.update(status, stats)
-                    with self.stats_lock:   
-                        if status:
-                            self.stats['processed_files'] += 1                                
-                            self.stats['original_size'] += stats['original_size']
-                            self.stats['processed_size'] += stats['processed_size']
-                                
-                        
-            # 通知进度跟踪器目录处理完成
+            tasks = self.create_tasks(pending_files)
+            # 不需要工作进程的轻量任务在父进程线程池中与进程池并行执行
+            local, tasks = self.split_local_tasks(tasks)
+            local_tasks.extend((input_path, task) for task in local)
+            pool_tasks.extend(tasks)
+            pool_task_dirs.extend([input_path] * len(tasks))
+        
+        # 进程池按任务数分块派发，减少逐个任务的序列化和队列开销，同时保留负载均衡；
+        # 线程池没有序列化开销，逐个派发让空闲线程立即取到下一个任务
+        chunksize = 1 if self.use_thread_pool else max(1, len(pool_tasks) // (self.workers * 4))
+        
+        prefetcher = InputPrefetcher(pending_all) if self.prefetch_inputs else None
+        if prefetcher:
+            prefetcher.start()
+        try:
+            with ThreadPoolExecutor(max_workers=LOCAL_TASK_WORKERS) as executor:
+                local_futures = [(input_path, executor.submit(self.process_local_task, task))
+                                 for input_path, task in local_tasks]
+                # 结果带回任务序号，用于找到所属目录
+                for index, result in pool.imap_unordered(self._process_indexed, enumerate(pool_tasks),
+                                                         chunksize=chunksize):
+                    self._consume_result(result, pool_task_dirs[index], prefetcher)
+                for input_path, future in local_futures:
+                    self._consume_result(future.result(), input_path, prefetcher)
+        finally:
+            if prefetcher:
+                prefetcher.stop()
+    
+    def _process_indexed(self, indexed_task):
+        """在工作进程中处理 (序号, 任务)，返回 (序号, 结果)"""
+        index, task = indexed_task
+        return index, self.process_file(task)
+    
+    def _consume_result(self, result, input_path, prefetcher=None):
+        """处理一个任务的返回结果 (批量任务返回结果列表，逐个文件更新进度)"""
+        for status, stats in (result if isinstance(result, list) else (result,)):
+            self._record_result(status, stats, input_path)
+            self.on_file_processed(status, stats)
+            if prefetcher:
+                prefetcher.advance()
+    
+    def _record_result(self, status, stats, input_path):
+        """更新进度和统计信息，目录的第一个结果到达时输出目录开始，最后一个到达时输出目录完成"""
+        relative_path, total, remaining = self._dir_progress[input_path]
+        if remaining == total:
+            self.progress_tracker.start_directory(input_path, relative_path, total)
+        self.progress_tracker.update(status, stats)
+        self._dir_progress[input_path][2] = remaining - 1
+        if remaining == 1:
             self.progress_tracker.finish_directory()
+        if status:
+            self.stats['processed_files'] += 1
+            self.stats['original_size'] += stats['original_size']
+            self.stats['processed_size'] += stats['processed_size']
+    
+    def __getstate__(self):
+        """传给工作进程时不序列化只在父进程中使用的对象"""
+        state = self.__dict__.copy()
+        for key in self.parent_only_attrs:
+            state.pop(key, None)
+        return state
+    
+    def _create_pool(self):
+        """按 use_thread_pool 和 start_method 创建线程池或进程池"""
+        if self.use_thread_pool:
+            return ThreadPool(processes=self.workers, initializer=self.init_worker)
+        ctx = multiprocessing.get_context(self.start_method)
+        if ctx.get_start_method() == "forkserver":
+            # forkserver 只导入一次模块，之后由它 fork 出干净的工作进程
+            ctx.set_forkserver_preload(list(self.forkserver_preload))
+        return ctx.Pool(processes=self.workers, initializer=_init_pool_worker,
+                        initargs=(self, get_log_queue()))
+    
+    def init_worker(self):
+        """工作进程启动时调用一次，子类可覆盖以预先完成初始化"""
+        pass
+    
+    def split_cached_files(self, files):
+        """拆分出已有缓存结果的文件，返回 ([(status, stats), ...], 待处理文件列表)
+        
+        默认不使用缓存，子类可覆盖
+        """
+        return [], files
+    
+    def prepare_files(self, files):
+        """在按目录创建任务前，对所有目录的待处理文件调用一次
         
-        # 递归处理每个子目录
-        for subdir in subdirs:
-            self._process_directory(subdir)
+        默认不做任何处理，子类可覆盖
+        """
+        pass
+    
+    def split_local_tasks(self, tasks):
+        """拆分出在父进程线程池中执行的轻量任务，返回 (本地任务列表, 进程池任务列表)
+        
+        默认全部交给进程池，子类可覆盖
+        """
+        return [], tasks
+    
+    def process_local_task(self, args):
+        """在父进程线程池中处理单个任务，默认与 process_file 相同"""
+        return self.process_file(args)
+    
+    def on_file_processed(self, status, stats):
+        """工作进程返回单个文件结果后在父进程中调用，子类可覆盖"""
+        pass
     
     @abstractmethod
     def create_tasks(self, files):
@@ -301,7 +467,7 @@ class MediaProcessor:
     
     @abstractmethod
     def process_file(self, args)-> (bool,object):
-        """处理单个文件（在子类中实现）"""
+        """处理单个文件（在子类中实现），批量任务可返回 (status, stats) 列表"""
         pass
     
     @abstractmethod
@@ -324,25 +490,26 @@ class MediaProcessor:
         total_files = len(all_files)
            
         if total_files == 0:
-            logI(f"未找到支持的文件 ({', '.join(self.supported_formats)})")
+            logI(f"未找到支持的文件 ({', '.join(sorted(self.supported_formats))})")
             return False
         
         logI(f"找到总计 {total_files} 个文件")
         
-        # 创建共享统计对象
-        manager = Manager()
-        self.stats = manager.dict()
-        self.stats['original_size'] = 0
-        self.stats['processed_size'] = 0
-        self.stats['processed_files'] = 0
-        self.stats_lock = manager.Lock()
+        # 统计信息只在父进程中更新 (工作进程只返回 (status, stats) 结果)
+        self.stats = {
+            'original_size': 0,
+            'processed_size': 0,
+            'processed_files': 0,
+        }
         
          
-        self.progress_tracker = GlobalProgressTracker(total_files)
+        self.progress_tracker = GlobalProgressTracker(total_files, self.verbose)
         
         # 开始处理目录
         start = time.time()
-        self._process_directory(self.directory_processor.input_base_dir)
+        # 进程池只创建一次，避免每个子目录重复启动工作进程
+        with self._create_pool() as pool:
+            self._process_directories(pool, all_files)
         
         # 显示跳过的文件和文件夹统计
         self.directory_processor.logI_skip_stats()
@@ -351,15 +518,14 @@ class MediaProcessor:
         self.progress_tracker.finish_all()
         
         # 处理完所有文件后
-        with self.stats_lock:
-            logI(f"\n总耗时: {time.time() - start:.2f} 秒")
-            logI(f"已处理 {self.stats['processed_files']} 个文件")
-            if self.stats['processed_files'] > 0:
-                logI(f"处理前总大小: {format_size(self.stats['original_size'])}")
-                logI(f"处理后总大小: {format_size(self.stats['processed_size'])}")
-                saved = self.stats['original_size'] - self.stats['processed_size']
-                saved_percentage = (saved / self.stats['original_size'] * 100) if self.stats['original_size'] > 0 else 0
-                logI(f"节省空间: {format_size(saved)} ({saved_percentage:.1f}%)")
+        logI(f"\n总耗时: {time.time() - start:.2f} 秒")
+        logI(f"已处理 {self.stats['processed_files']} 个文件")
+        if self.stats['processed_files'] > 0:
+            logI(f"处理前总大小: {format_size(self.stats['original_size'])}")
+            logI(f"处理后总大小: {format_size(self.stats['processed_size'])}")
+            saved = self.stats['original_size'] - self.stats['processed_size']
+            saved_percentage = (saved / self.stats['original_size'] * 100) if self.stats['original_size'] > 0 else 0
+            logI(f"节省空间: {format_size(saved)} ({saved_percentage:.1f}%)")
         
         return True
 
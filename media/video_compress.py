@@ -1,8 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
+import hashlib
+import json
+import platform
+import shlex
+import shutil
 import subprocess
 import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import time
 import uuid
@@ -10,9 +19,55 @@ import os
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 sys.path.append(parent_dir)
 from utils.logger import setup_logging, logI
+from utils.metadata_cache import MetadataCache
 from media_process import (
     MediaProcessor, calc_save_space , format_size
 )
+from backends import pynvc_backend
+
+# 硬件编码器检测结果缓存: 进程内缓存 (ffmpeg命令, (编码器, 质量参数))，以及输入目录下的 JSON 文件
+HW_CAPS_FILE = ".ffmpeg_caps.json"
+# 硬件编码器实际编码验证通过后的标记文件，内容为 ffmpeg 路径+修改时间的哈希及编码器名，跨输入目录共用
+HW_OK_FILE = Path.home() / ".cache" / "video_compress" / "hw_ok"
+# 硬件编码器及其质量参数，按优先顺序: qsv > vaapi > videotoolbox > nvenc > amf
+HW_ENCODERS = (
+    ("hevc_qsv", "-global_quality"),
+    ("hevc_vaapi", "-qp"),
+    ("hevc_videotoolbox", "-q"),
+    ("hevc_nvenc", "-cq"),
+    ("hevc_amf", "-qp"),
+)
+# 测试编码时需要先初始化硬件设备的编码器
+HW_TEST_INIT_ARGS = {
+    "hevc_vaapi": ["-vaapi_device", "/dev/dri/renderD128"],
+}
+_HW_ENCODER_CACHE = None
+_HW_ENCODER_LOCK = threading.Lock()
+# 输入目录下的视频元数据 (码率) 缓存，记录 (进程号, 数据库路径, MetadataCache)
+METADATA_CACHE_FILE = ".video_metadata.db"
+_METADATA_CACHE = None
+# 预先探测码率时的最大并发 ffprobe 数
+PROBE_WORKERS = 32
+# ffmpeg 出错时保留的 stderr 行数
+STDERR_TAIL_LINES = 200
+# 未指定码率时，这些硬件编码器按原始码率的比例使用限峰值的 VBR (-b:v/-maxrate/-bufsize)，上限 4Mbps
+CAPPED_VBR_ENCODERS = ("hevc_videotoolbox", "hevc_nvenc", "hevc_qsv")
+CAPPED_VBR_RATIO = 0.6
+CAPPED_VBR_MAX = 4_000_000
+# 同一目录下需要编码的视频合并为一次 ffmpeg 调用的最大数量
+VIDEO_BATCH_SIZE = 8
+# 各硬件编码器对应的硬件解码参数 (放在 -i 之前)，解码后的帧留在显存中直接送入编码器
+HW_DECODE_ARGS = {
+    "hevc_qsv": ["-hwaccel", "qsv", "-hwaccel_output_format", "qsv"],
+    "hevc_nvenc": ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"],
+    "hevc_videotoolbox": ["-hwaccel", "videotoolbox"],
+    "hevc_vaapi": ["-hwaccel", "vaapi", "-hwaccel_device", "/dev/dri/renderD128",
+                   "-hwaccel_output_format", "vaapi"],
+}
+# 硬件解码需要配套的滤镜参数 (软件解码回退时也能把帧上传到 GPU)
+HW_FILTER_ARGS = {
+    "hevc_vaapi": ["-vf", "format=nv12|vaapi,hwupload"],
+}
 
 def get_ffmpeg_command():
     """获取可用的ffmpeg命令"""
@@ -23,66 +78,201 @@ def get_ffmpeg_command():
     except (subprocess.CalledProcessError, FileNotFoundError):
         return "ffmpeg"
 
-def get_video_bitrate(video_path):
-    """使用ffmpeg命令行获取视频的原始码率"""
-    ffmpeg_cmd = get_ffmpeg_command()
+def get_ffprobe_command(ffmpeg_cmd=None):
+    """获取与ffmpeg命令对应的ffprobe命令 (如 ffmpeg7 -> ffprobe7)，找不到时回退到 ffprobe"""
+    ffprobe_cmd = (ffmpeg_cmd or get_ffmpeg_command()).replace("ffmpeg", "ffprobe")
+    if ffprobe_cmd != "ffprobe" and shutil.which(ffprobe_cmd) is None:
+        return "ffprobe"
+    return ffprobe_cmd
+
+def probe_bitrate(ffprobe_cmd, video_path, entry):
+    """使用ffprobe读取单个码率字段 (bps)，字段不存在或为 N/A 时返回 None"""
+    result = subprocess.run([
+        ffprobe_cmd,
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", entry,
+        "-of", "csv=p=0",
+        str(video_path),
+    ], capture_output=True, text=True, timeout=30)
+    lines = result.stdout.split()
+    return int(lines[0]) if lines and lines[0].isdigit() else None
+
+def get_metadata_cache(cache_dir):
+    """获取当前进程的元数据缓存 (每个进程打开一次，sqlite 连接不跨进程共享)"""
+    global _METADATA_CACHE
+    db_file = Path(cache_dir) / METADATA_CACHE_FILE
+    if _METADATA_CACHE is None or _METADATA_CACHE[:2] != (os.getpid(), db_file):
+        _METADATA_CACHE = (os.getpid(), db_file, MetadataCache(db_file))
+    return _METADATA_CACHE[2]
+
+def probe_video_bitrate(video_path, ffprobe_cmd=None):
+    """使用ffprobe获取视频的原始码率 (bps)，失败时返回 None"""
     try:
-        cmd = [
-            ffmpeg_cmd,
-            "-i", str(video_path),
-            "-hide_banner",
-        ]
-        process = subprocess.run(cmd, stderr=subprocess.PIPE, text=True)
-        output = process.stderr
-        # 查找视频流信息
-        for line in output.splitlines():
-            if "Stream #" in line and "Video:" in line:
-                # 提取码率信息
-                parts = line.split(",")
-                for part in parts:
-                    if "kb/s" in part.strip():
-                        bitrate_str = part.strip().split(" ")[0]
-                        return int(float(bitrate_str) * 1000)  # 转换为 bps
-        return None
+        ffprobe_cmd = ffprobe_cmd or get_ffprobe_command()
+        # 视频流没有码率信息时使用容器的整体码率
+        return probe_bitrate(ffprobe_cmd, video_path, "stream=bit_rate") \
+            or probe_bitrate(ffprobe_cmd, video_path, "format=bit_rate")
     except Exception as e:
         logI(f"无法获取视频码率: {e}")
         return None
 
+def get_video_bitrates(videos, cache=None, ffprobe_cmd=None):
+    """并发探测多个视频的原始码率，返回 {路径: 码率}
+    
+    ffprobe 是独立子进程，线程即可并发；缓存只在调用线程中读写 (sqlite 连接不跨线程)
+    ffprobe_cmd 由调用方解析一次后传入，避免每次探测都执行 ffmpeg -version
+    """
+    bitrates = {}
+    to_probe = []
+    for video in videos:
+        st = Path(video).stat()
+        bitrate = cache.get_bitrate(video, st.st_size, st.st_mtime) if cache is not None else None
+        if bitrate is not None:
+            bitrates[video] = bitrate
+        else:
+            to_probe.append((video, st))
+    
+    if to_probe:
+        with ThreadPoolExecutor(max_workers=min(PROBE_WORKERS, len(to_probe))) as executor:
+            ffprobe_cmd = ffprobe_cmd or get_ffprobe_command()
+            probed = executor.map(probe_video_bitrate, [video for video, _ in to_probe],
+                                  [ffprobe_cmd] * len(to_probe))
+            for (video, st), bitrate in zip(to_probe, probed):
+                bitrates[video] = bitrate
+                if bitrate is not None and cache is not None:
+                    cache.set_bitrate(video, st.st_size, st.st_mtime, bitrate)
+    return bitrates
+
+@functools.lru_cache(maxsize=None)
+def get_encoder_names(ffmpeg_cmd):
+    """解析 ffmpeg -encoders 的输出为编码器名称集合 (同一 ffmpeg 在进程内只执行一次)"""
+    result = subprocess.run([ffmpeg_cmd, "-encoders"], 
+                          stdout=subprocess.PIPE, 
+                          stderr=subprocess.PIPE,
+                          text=True)
+    # 每行格式: " V....D hevc_nvenc  NVIDIA NVENC hevc encoder"
+    return frozenset(
+        parts[1] for parts in map(str.split, result.stdout.splitlines())
+        if len(parts) >= 2 and len(parts[0]) == 6
+    )
+
+def get_hw_ok_key(ffmpeg_cmd):
+    """ffmpeg 可执行文件路径+修改时间的哈希，ffmpeg 更新后失效；找不到可执行文件时返回 None"""
+    ffmpeg_path = shutil.which(ffmpeg_cmd)
+    if not ffmpeg_path:
+        return None
+    return hashlib.sha1(f"{ffmpeg_cmd}:{os.stat(ffmpeg_path).st_mtime}".encode()).hexdigest()
+
+def is_hw_validated(key, encoder):
+    """硬件编码器是否已在本机用同一个 ffmpeg 验证通过"""
+    try:
+        return key is not None and HW_OK_FILE.read_text().strip() == f"{key}:{encoder}"
+    except OSError:
+        return False
+
+def mark_hw_validated(key, encoder):
+    """记录硬件编码器验证通过，写入失败不影响编码"""
+    if key is None:
+        return
+    try:
+        HW_OK_FILE.parent.mkdir(parents=True, exist_ok=True)
+        HW_OK_FILE.write_text(f"{key}:{encoder}")
+    except OSError as e:
+        logI(f"写入硬件验证缓存失败: {e}")
+
+def test_hardware_encoder(ffmpeg_cmd, encoder):
+    """用 lavfi 测试源实际编码 1 秒，验证硬件编码器可用 (发行版 ffmpeg 在没有对应硬件时也会列出编码器)"""
+    test_cmd = [ffmpeg_cmd, "-hide_banner", *HW_TEST_INIT_ARGS.get(encoder, []),
+                "-f", "lavfi", "-i", "testsrc=duration=1:size=320x240:rate=10",
+                *HW_FILTER_ARGS.get(encoder, []), "-c:v", encoder, "-f", "null", "-"]
+    test_result = subprocess.run(test_cmd, 
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               text=True)
+    return test_result.returncode == 0
+
 def check_hardware_encoder(ffmpeg_cmd):
-    """检查可用的硬件编码器"""
+    """检查可用的硬件编码器 (按优先顺序逐个实际测试编码，返回第一个可用的)"""
     try:
         # 检查支持的硬件编码器
-        result = subprocess.run([ffmpeg_cmd, "-encoders"], 
-                              stdout=subprocess.PIPE, 
-                              stderr=subprocess.PIPE,
-                              text=True)
-        encoders = result.stdout
-        
-        # 优先顺序: qsv > vaapi > videotoolbox > nvenc > amf
-        if "hevc_qsv" in encoders:
-            # 额外验证qsv是否真的可用
-            test_cmd = [ffmpeg_cmd, "-hide_banner", "-f", "lavfi", "-i", "testsrc", 
-                       "-c:v", "hevc_qsv", "-f", "null", "-"]
-            test_result = subprocess.run(test_cmd, 
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE,
-                                       text=True)
-            if test_result.returncode == 0:
-                return ("hevc_qsv", "-global_quality")
+        encoders = get_encoder_names(ffmpeg_cmd)
+        hw_ok_key = get_hw_ok_key(ffmpeg_cmd)
         
-        if "hevc_vaapi" in encoders:
-            return ("hevc_vaapi", "-qp")
-        if "hevc_videotoolbox" in encoders:
-            return ("hevc_videotoolbox", "-q")
-        if "hevc_nvenc" in encoders:
-            return ("hevc_nvenc", "-cq")
-        if "hevc_amf" in encoders:
-            return ("hevc_amf", "-qp")
+        for encoder, quality_param in HW_ENCODERS:
+            if encoder not in encoders:
+                continue
+            # 本机已验证过同一个 ffmpeg 时跳过测试编码
+            if is_hw_validated(hw_ok_key, encoder):
+                return (encoder, quality_param)
+            if test_hardware_encoder(ffmpeg_cmd, encoder):
+                mark_hw_validated(hw_ok_key, encoder)
+                return (encoder, quality_param)
+            logI(f"硬件编码器 {encoder} 测试失败，跳过")
         return (None, None)
     except Exception as e:
         logI(f"检查硬件编码器失败: {e}")
         return None
 
+def get_ffmpeg_version_hash(ffmpeg_cmd):
+    """获取ffmpeg版本信息的哈希，用于判断能力缓存是否失效"""
+    result = subprocess.run([ffmpeg_cmd, "-version"],
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return hashlib.sha1(result.stdout).hexdigest()
+
+def get_hardware_encoder(ffmpeg_cmd, cache_dir=None):
+    """获取可用的硬件编码器，结果缓存在进程内及 cache_dir 下的 JSON 文件中
+    
+    ffmpeg 版本变化时文件缓存失效；检测出错的结果不写入文件
+    """
+    global _HW_ENCODER_CACHE
+    with _HW_ENCODER_LOCK:
+        if _HW_ENCODER_CACHE is not None and _HW_ENCODER_CACHE[0] == ffmpeg_cmd:
+            return _HW_ENCODER_CACHE[1]
+        
+        version = get_ffmpeg_version_hash(ffmpeg_cmd)
+        caps_file = Path(cache_dir) / HW_CAPS_FILE if cache_dir else None
+        result = None
+        if caps_file and caps_file.exists():
+            try:
+                caps = json.loads(caps_file.read_text())
+                if caps.get("ffmpeg") == ffmpeg_cmd and caps.get("version") == version:
+                    result = (caps["encoder"], caps["param"])
+            except (OSError, ValueError, KeyError):
+                pass
+        
+        if result is None:
+            result = check_hardware_encoder(ffmpeg_cmd)
+            if result is None:
+                return (None, None)
+            if caps_file:
+                # 先写临时文件再原子替换，避免多个工作进程同时写入时读到不完整的文件
+                temp_file = caps_file.with_name(f"{HW_CAPS_FILE}.{os.getpid()}.tmp")
+                try:
+                    temp_file.write_text(json.dumps({
+                        "encoder": result[0], "param": result[1],
+                        "ffmpeg": ffmpeg_cmd, "version": version,
+                    }))
+                    os.replace(temp_file, caps_file)
+                except OSError as e:
+                    logI(f"写入硬件编码器缓存失败: {e}")
+        
+        _HW_ENCODER_CACHE = (ffmpeg_cmd, result)
+        return result
+
+def disable_hardware_encoder(ffmpeg_cmd, cache_dir=None):
+    """硬件编码在运行时失败: 本次运行剩余的文件直接使用软件编码，并清除文件缓存，下次运行重新检测"""
+    global _HW_ENCODER_CACHE
+    with _HW_ENCODER_LOCK:
+        _HW_ENCODER_CACHE = (ffmpeg_cmd, (None, None))
+        for path in (Path(cache_dir) / HW_CAPS_FILE if cache_dir else None, HW_OK_FILE):
+            if path is None:
+                continue
+            try:
+                path.unlink(missing_ok=True)
+            except OSError as e:
+                logI(f"清除硬件编码器缓存失败: {e}")
+
 def get_output_path(video_path, input_base_dir, output_base_dir):
     """计算输出路径和临时文件路径"""
     rel_path = video_path.relative_to(input_base_dir)
@@ -108,38 +298,38 @@ def parse_bitrate(bitrate_str):
         return int(bitrate_str[:-1]) * 1024 * 1024
     return int(bitrate_str)
 
-def prepare_ffmpeg_command(video_path, ffmpeg_cmd, bitrate, crf, preset, use_software, original_bitrate=None):
-    """准备ffmpeg命令"""
-    cmd = [ffmpeg_cmd, "-i", f'"{str(video_path)}"']
+def get_capped_bitrate(hw_encoder, bitrate, crf, original_bitrate):
+    """未指定码率时硬件编码器的目标码率: min(原始码率 × 0.6, 4Mbps)，不适用时返回 None"""
+    if (hw_encoder in CAPPED_VBR_ENCODERS and not bitrate and original_bitrate
+            and (crf is None or hw_encoder == "hevc_videotoolbox")):
+        return int(min(original_bitrate * CAPPED_VBR_RATIO, CAPPED_VBR_MAX))
+    return None
+
+def prepare_ffmpeg_command(video_path, ffmpeg_cmd, bitrate, crf, preset, use_software, original_bitrate=None,
+                           cache_dir=None, threads=None):
+    """准备ffmpeg命令 (cache_dir 用于缓存硬件编码器检测结果，threads 为单个 ffmpeg 的线程数)"""
+    # -threads 放在 -i 之前限制解码线程，放在输出前限制编码线程
+    input_args = ["-threads", str(threads), "-i", str(video_path)] if threads else ["-i", str(video_path)]
+    cmd = [ffmpeg_cmd, *input_args]
+    hw_encoder = None
     
     # 检测并选择编码器
     if not use_software:
-        hw_encoder, hw_quality_param = check_hardware_encoder(ffmpeg_cmd)
+        hw_encoder, hw_quality_param = get_hardware_encoder(ffmpeg_cmd, cache_dir)
+        # 编码器已在检测时实际测试过，运行时失败由 process_video 改用软件编码重试
         if hw_encoder:
-            original_cmd = cmd.copy()
-            try:
-                cmd.extend(["-c:v", hw_encoder, "-tag:v", "hvc1"])
-                if preset:
-                    cmd.extend(["-preset", preset])
-                    
-                    if hw_encoder == "hevc_videotoolbox":
-                        if bitrate:
-                            cmd.extend(["-b:v", bitrate])
-                        else:
-                            cmd.extend(["-q:v", "70"])
-                    elif hw_quality_param and crf and not bitrate:
-                        cmd.extend([hw_quality_param, str(crf)])
-                
-                # 测试硬件编码器
-                test_cmd = cmd + ["-f", "null", "-"]
-                test_result = subprocess.run(' '.join(test_cmd), shell=True,
-                                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                if test_result.returncode != 0:
-                    raise RuntimeError(f"硬件编码器 {hw_encoder} 测试失败")
+            # 硬件解码 + 硬件编码，避免 CPU 解码成为瓶颈
+            cmd = [ffmpeg_cmd, *HW_DECODE_ARGS.get(hw_encoder, []), *input_args]
+            cmd.extend(HW_FILTER_ARGS.get(hw_encoder, []))
+            cmd.extend(["-c:v", hw_encoder, "-tag:v", "hvc1"])
+            if preset:
+                cmd.extend(["-preset", preset])
                 
-            except Exception:
-                cmd = original_cmd
-                use_software = True
+                if hw_encoder != "hevc_videotoolbox" and hw_quality_param and crf and not bitrate:
+                    cmd.extend([hw_quality_param, str(crf)])
+        else:
+            # 没有可用的硬件编码器 (或已在运行时禁用)
+            use_software = True
     
     if use_software:
         cmd.extend(["-c:v", "libx265", "-tag:v", "hvc1"])
@@ -147,9 +337,15 @@ def prepare_ffmpeg_command(video_path, ffmpeg_cmd, bitrate, crf, preset, use_sof
             cmd.extend(["-preset", preset])
         cmd.extend(["-c:a", "aac", "-b:a", "128k"])
     
+    # 硬件编码器未指定码率时 (videotoolbox 不支持 crf)，按原始码率推算目标码率并限制峰值，输出大小可控
+    capped_target = get_capped_bitrate(hw_encoder, bitrate, crf, original_bitrate) if not use_software else None
+    
     # 设置码率参数
     if original_bitrate and bitrate and parse_bitrate(bitrate) >= original_bitrate:
         logI("原始码率低于目标码率，进行无损转换")
+    elif capped_target:
+        cmd.extend(["-b:v", str(capped_target), "-maxrate", str(capped_target),
+                    "-bufsize", str(2 * capped_target)])
     else:
         if bitrate:
             cmd.extend(["-b:v", bitrate])
@@ -158,30 +354,56 @@ def prepare_ffmpeg_command(video_path, ffmpeg_cmd, bitrate, crf, preset, use_sof
         else:
             cmd.extend(["-b:v", "1M"])
     
+    # 限制线程数，避免多个 ffmpeg 进程各自按核数开线程造成过度订阅
+    if threads:
+        cmd.extend(["-threads", str(threads),
+                    "-filter_threads", str(threads), "-filter_complex_threads", str(threads)])
+    
     return cmd
 
-def execute_ffmpeg(cmd, temp_file):
-    """执行ffmpeg命令"""
-    logI(f"执行命令: {' '.join(cmd)}")
-    process = subprocess.Popen(' '.join(cmd), shell=True,
+def _drain_stderr(stream, tail):
+    """后台读取 stderr，只保留最后若干行用于报错"""
+    for line in stream:
+        tail.append(line.rstrip("\n"))
+
+def run_ffmpeg(cmd):
+    """执行ffmpeg命令并显示进度，失败时抛出 CalledProcessError"""
+    # 进度走 stdout 的 key=value 输出，关闭 stderr 上的统计行
+    cmd = [cmd[0], "-progress", "pipe:1", "-nostats"] + cmd[1:]
+    logI(f"执行命令: {shlex.join(cmd)}")
+    # 直接传入参数列表，不经过 shell，文件名中的空格和引号无需转义
+    process = subprocess.Popen(cmd,
                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                             text=True)
-    
-    # 实时显示进度
-    while True:
-        line = process.stderr.readline()
-        if not line:
-            break
-        if "frame=" in line or "time=" in line:
-            print(line.strip(), end="\r", flush=True)
-    
+                             text=True, bufsize=1)
+
+    # stderr 必须持续读取，否则管道写满会阻塞 ffmpeg
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+    stderr_thread = threading.Thread(target=_drain_stderr,
+                                     args=(process.stderr, stderr_tail), daemon=True)
+    stderr_thread.start()
+
+    # 每个进度块以 progress= 结尾，只在块结束时刷新一次终端
+    progress = {}
+    for line in process.stdout:
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            continue
+        if key == "progress":
+            print(f"frame={progress.get('frame', '0')} time={progress.get('out_time', '')} "
+                  f"speed={progress.get('speed', '')}", end="\r", flush=True)
+        else:
+            progress[key] = value
+
     process.wait()
+    stderr_thread.join()
     if process.returncode != 0:
-        error_output = process.stderr.read()
         raise subprocess.CalledProcessError(
-            process.returncode, cmd, output=process.stdout, stderr=error_output
+            process.returncode, cmd, stderr="\n".join(stderr_tail)
         )
-    
+
+def execute_ffmpeg(cmd, temp_file):
+    """执行ffmpeg命令"""
+    run_ffmpeg(cmd)
     if not temp_file.exists():
         raise RuntimeError("ffmpeg命令执行失败，未生成输出文件")
 
@@ -195,46 +417,73 @@ def handle_result(video_path, output_path, temp_file, rel_path):
             **stats
         }
     
-    import shutil
-    shutil.move(str(temp_file), str(output_path))
+    # 临时文件与输出文件在同一目录，原子重命名即可
+    os.replace(temp_file, output_path)
     stats = calc_save_space(video_path, output_path)
     return True, {
         "message": f"{stats['formatted_text']}",
         **stats
     }
 
-def process_video(args):
-    """处理单个视频的独立函数（供多进程调用）"""
-    video_path, input_base_dir, output_base_dir, bitrate, crf, preset, use_software = args
-    logI(f"开始处理视频: {video_path.name}")
-    
-    # 获取原始码率
-    original_bitrate = get_video_bitrate(video_path)
+def should_copy(original_bitrate, bitrate):
+    """原始码率不高于目标码率时无需重新编码，直接复制"""
     target_bitrate = parse_bitrate(bitrate) if bitrate else None
-    logI(f"原始码率: {format_size(original_bitrate)}  目标码率: {format_size(target_bitrate)}")
+    return bool(original_bitrate and target_bitrate and original_bitrate <= target_bitrate)
+
+def _reflink_or_copy(src, dst):
+    """优先使用写时复制克隆文件 (Linux Btrfs/XFS reflink，macOS APFS clonefile)，不支持时回退到普通复制"""
+    system = platform.system()
+    if system == "Linux":
+        clone_cmd = ["cp", "--reflink=always", str(src), str(dst)]
+    elif system == "Darwin":
+        clone_cmd = ["cp", "-c", str(src), str(dst)]
+    else:
+        clone_cmd = None
     
-    # 如果原始码率低于目标码率，直接复制文件
-    if original_bitrate and target_bitrate and original_bitrate <= target_bitrate:
-        logI(f"原始码率低于目标码率，直接复制文件")
-        rel_path, output_path, _ = get_output_path(video_path, input_base_dir, output_base_dir)
-        logI(f"开始复制: {video_path} -> {output_path}")
-        if output_path.exists():
-            stats = calc_save_space(video_path, output_path)
-            logI(f"已存在,跳过复制: {video_path} -> {output_path}")
-            return True, {
-                "message": f"{stats['formatted_text']} (已存在，跳过)",
-                **stats
-            }
-        
-        import shutil
-        shutil.copy2(video_path, output_path)
+    if clone_cmd:
+        result = subprocess.run(clone_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if result.returncode == 0:
+            shutil.copystat(src, dst)
+            return
+    shutil.copy2(src, dst)
+
+def copy_video(args):
+    """直接复制视频 (原始码率不高于目标码率时使用，只涉及文件I/O，可在线程池中调用)"""
+    video_path, input_base_dir, output_base_dir = args[:3]
+    rel_path, output_path, _ = get_output_path(video_path, input_base_dir, output_base_dir)
+    
+    if output_path.exists():
         stats = calc_save_space(video_path, output_path)
-        logI(f"复制完成: {video_path} -> {output_path}")
         return True, {
-            "message": f"{stats['formatted_text']}",
+            "message": f"{stats['formatted_text']} (已存在，跳过)",
             **stats
         }
     
+    logI(f"原始码率低于目标码率，直接复制文件")
+    logI(f"开始复制: {video_path} -> {output_path}")
+    try:
+        _reflink_or_copy(video_path, output_path)
+    except OSError as e:
+        return False, {
+            "message": f"{rel_path} (error: {str(e)})"
+        }
+    stats = calc_save_space(video_path, output_path)
+    logI(f"复制完成: {video_path} -> {output_path}")
+    return True, {
+        "message": f"{stats['formatted_text']}",
+        **stats
+    }
+
+def can_use_pynvc(ffmpeg_cmd, use_software, crf, cache_dir):
+    """NVIDIA 机器上装了 PyNvVideoCodec 时，码率模式直接走 GPU 解码+编码"""
+    return (pynvc_backend.HAS_PYNVC and not use_software and crf is None
+            and get_hardware_encoder(ffmpeg_cmd, cache_dir)[0] == "hevc_nvenc")
+
+def process_video(args, ffmpeg_cmd=None):
+    """处理单个视频的独立函数（供多进程调用），ffmpeg_cmd 由调用方解析一次后传入"""
+    video_path, input_base_dir, output_base_dir, bitrate, crf, preset, use_software, threads, original_bitrate = args
+    logI(f"开始处理视频: {video_path.name}")
+    
     # 准备输出路径
     rel_path, output_path, temp_file = get_output_path(video_path, input_base_dir, output_base_dir)
     
@@ -246,13 +495,52 @@ def process_video(args):
             **stats
         }
     
+    # 原始码率已由父进程在创建任务时统一探测
+    target_bitrate = parse_bitrate(bitrate) if bitrate else None
+    logI(f"原始码率: {format_size(original_bitrate) if original_bitrate else '未知'}  "
+         f"目标码率: {format_size(target_bitrate) if target_bitrate else '未指定'}")
+    
+    # 如果原始码率低于目标码率，直接复制文件
+    if should_copy(original_bitrate, bitrate):
+        return copy_video(args)
+    
+    ffmpeg_cmd = ffmpeg_cmd or get_ffmpeg_command()
+    
+    if can_use_pynvc(ffmpeg_cmd, use_software, crf, input_base_dir):
+        try:
+            # 与 ffmpeg 路径使用相同的码率: 指定码率 > 按原始码率推算的上限码率 > 1M
+            nvc_bitrate = (target_bitrate or get_capped_bitrate("hevc_nvenc", bitrate, crf, original_bitrate)
+                           or 1_000_000)
+            pynvc_backend.encode(video_path, temp_file, nvc_bitrate, ffmpeg_cmd)
+            return handle_result(video_path, output_path, temp_file, rel_path)
+        except Exception as e:
+            logI(f"PyNvVideoCodec 编码失败，回退到 ffmpeg: {e}")
+            if temp_file.exists():
+                temp_file.unlink()
+    
     # 准备并执行ffmpeg命令
-    ffmpeg_cmd = get_ffmpeg_command()
-    cmd = prepare_ffmpeg_command(video_path, ffmpeg_cmd, bitrate, crf, preset, use_software, original_bitrate)
-    cmd.append(f'"{str(temp_file)}"')
+    cmd = prepare_ffmpeg_command(video_path, ffmpeg_cmd, bitrate, crf, preset, use_software, original_bitrate,
+                                 cache_dir=input_base_dir, threads=threads)
+    cmd.append(str(temp_file))
+    
+    # 没有可用的硬件编码器时 prepare_ffmpeg_command 已改用 libx265
+    used_hardware = not use_software and "libx265" not in cmd
     
     try:
-        execute_ffmpeg(cmd, temp_file)
+        try:
+            execute_ffmpeg(cmd, temp_file)
+        except subprocess.CalledProcessError as e:
+            if not used_hardware:
+                raise
+            # 硬件编码在运行时失败，禁用硬件编码后用软件编码重试一次
+            logI(f"硬件编码失败 (error code {e.returncode})，改用软件编码: {video_path.name}")
+            disable_hardware_encoder(ffmpeg_cmd, input_base_dir)
+            if temp_file.exists():
+                temp_file.unlink()
+            cmd = prepare_ffmpeg_command(video_path, ffmpeg_cmd, bitrate, crf, preset, True, original_bitrate,
+                                         cache_dir=input_base_dir, threads=threads)
+            cmd.append(str(temp_file))
+            execute_ffmpeg(cmd, temp_file)
         return handle_result(video_path, output_path, temp_file, rel_path)
     except subprocess.CalledProcessError as e:
         if temp_file.exists():
@@ -268,21 +556,77 @@ def process_video(args):
             "message": f"{rel_path} (error: {str(e)})"
         }
 
+def process_video_batch(tasks, ffmpeg_cmd=None):
+    """在一次 ffmpeg 调用中编码同一目录下的多个视频 (进程启动和硬件初始化只做一次)，返回结果列表"""
+    ffmpeg_cmd = ffmpeg_cmd or get_ffmpeg_command()
+    if len(tasks) == 1:
+        return [process_video(tasks[0], ffmpeg_cmd)]
+    _, input_base_dir, output_base_dir, bitrate, crf, preset, use_software, threads, _ = tasks[0]
+    # 一个 ffmpeg 同时编码整批视频，线程预算在批内平分
+    threads = max(1, threads // len(tasks)) if threads else threads
+    # PyNvVideoCodec 后端按单个文件处理
+    if can_use_pynvc(ffmpeg_cmd, use_software, crf, input_base_dir):
+        return [process_video(task, ffmpeg_cmd) for task in tasks]
+    
+    # 每个视频单独生成命令，再拆成输入部分和输出部分拼接: 输入 k 只映射到输出 k
+    input_args = []
+    output_args = []
+    jobs = []
+    for index, task in enumerate(tasks):
+        video_path, original_bitrate = task[0], task[-1]
+        logI(f"开始处理视频: {video_path.name} (批量 {index + 1}/{len(tasks)})")
+        rel_path, output_path, temp_file = get_output_path(video_path, input_base_dir, output_base_dir)
+        cmd = prepare_ffmpeg_command(video_path, ffmpeg_cmd, bitrate, crf, preset, use_software,
+                                     original_bitrate, cache_dir=input_base_dir, threads=threads)
+        split = cmd.index("-i") + 2
+        input_args.extend(cmd[1:split])
+        output_args.extend(["-map", f"{index}:v:0", "-map", f"{index}:a:0?", *cmd[split:], str(temp_file)])
+        jobs.append((video_path, rel_path, output_path, temp_file))
+    
+    try:
+        run_ffmpeg([ffmpeg_cmd, *input_args, *output_args])
+    except subprocess.CalledProcessError as e:
+        # 批量失败时逐个重试，避免一个坏文件拖累同批的其他视频
+        logI(f"批量编码失败 (error code {e.returncode})，逐个重新处理")
+        for *_, temp_file in jobs:
+            if temp_file.exists():
+                temp_file.unlink()
+        return [process_video(task, ffmpeg_cmd) for task in tasks]
+    
+    results = []
+    for video_path, rel_path, output_path, temp_file in jobs:
+        if temp_file.exists():
+            results.append(handle_result(video_path, output_path, temp_file, rel_path))
+        else:
+            results.append((False, {"message": f"{rel_path} (error: ffmpeg命令执行失败，未生成输出文件)"}))
+    return results
+
 
 class VideoCompressor(MediaProcessor):
     """视频压缩器类"""
     
-    def __init__(self, input_dir, bitrate=None, crf=None, preset=None, workers=1, use_software=False):
-        super().__init__(input_dir, workers)
+    # 编码时间几乎都花在等待 ffmpeg 子进程上，在父进程中用线程调度即可
+    use_thread_pool = True
+    
+    def __init__(self, input_dir, bitrate=None, crf=None, preset=None, workers=1, use_software=False, verbose=False):
+        super().__init__(input_dir, workers, verbose=verbose)
         self.bitrate = bitrate
         self.crf = crf
         self.preset = preset
         self.use_software = use_software
-        self.supported_formats = (".mp4", ".mov", ".avi", ".mkv", ".webm", ".flv", ".m4v")
+        # ffmpeg / ffprobe 命令在整个运行期间只解析一次
+        self.ffmpeg_cmd = get_ffmpeg_command()
+        self.ffprobe_cmd = None
+        # prepare_files 探测的 {路径: 码率}，以及输出尚不存在、需要处理的视频
+        self.bitrates = {}
+        self.pending_videos = set()
+        # 所有工作进程的 ffmpeg 线程总数与 CPU 核数相当
+        self.threads_per_worker = max(1, (os.cpu_count() or 1) // self.workers)
+        self.supported_formats = frozenset({".mp4", ".mov", ".avi", ".mkv", ".webm", ".flv", ".m4v"})
     
     def check_dependencies(self):
         """检查ffmpeg工具是否已安装"""
-        ffmpeg_cmd = get_ffmpeg_command()
+        ffmpeg_cmd = self.ffmpeg_cmd
         try:
             subprocess.run([ffmpeg_cmd, "-version"], check=True,
                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
@@ -294,25 +638,65 @@ class VideoCompressor(MediaProcessor):
             print("  Linux: sudo apt-get install ffmpeg")
             return False
     
+    def prepare_files(self, files):
+        """在父进程中一次性并发探测所有目录待处理视频的码率"""
+        input_base_dir = self.directory_processor.input_base_dir
+        output_base_dir = self.directory_processor.output_base_dir
+        # 输出已存在的视频会被跳过，无需探测
+        to_probe = [video for video in files
+                    if not (output_base_dir / video.relative_to(input_base_dir)).exists()]
+        if self.ffprobe_cmd is None:
+            self.ffprobe_cmd = get_ffprobe_command(self.ffmpeg_cmd)
+        self.bitrates = get_video_bitrates(to_probe, get_metadata_cache(input_base_dir), self.ffprobe_cmd)
+        self.pending_videos = set(to_probe)
+    
     def create_tasks(self, files):
-        """创建处理任务列表"""
-        return [
-            (video, self.directory_processor.input_base_dir, self.directory_processor.output_base_dir, 
-             self.bitrate, self.crf, self.preset, self.use_software) 
+        """创建处理任务列表 (码率已由 prepare_files 探测)
+        
+        需要编码的视频按 VIDEO_BATCH_SIZE 分批，每批合并为一次 ffmpeg 调用
+        """
+        input_base_dir = self.directory_processor.input_base_dir
+        output_base_dir = self.directory_processor.output_base_dir
+        tasks = [
+            (video, input_base_dir, output_base_dir, 
+             self.bitrate, self.crf, self.preset, self.use_software, self.threads_per_worker,
+             self.bitrates.get(video))
             for video in files
         ]
+        
+        single_tasks = []
+        encode_tasks = []
+        for task in tasks:
+            if task[0] in self.pending_videos and not should_copy(task[-1], self.bitrate):
+                encode_tasks.append(task)
+            else:
+                single_tasks.append(task)
+        # 文件较少时减小批大小，保证每个工作进程都有任务
+        batch_size = max(1, min(VIDEO_BATCH_SIZE, -(-len(encode_tasks) // self.workers)))
+        return single_tasks + [encode_tasks[i:i + batch_size]
+                               for i in range(0, len(encode_tasks), batch_size)]
+    
+    def split_local_tasks(self, tasks):
+        """只需复制的视频交给父进程的线程池，编码进程池只处理需要编码的视频"""
+        local_tasks = []
+        pool_tasks = []
+        for task in tasks:
+            if not isinstance(task, list) and should_copy(task[-1], self.bitrate):
+                local_tasks.append(task)
+            else:
+                pool_tasks.append(task)
+        return local_tasks, pool_tasks
+    
+    def process_local_task(self, args):
+        """在父进程线程池中复制视频"""
+        return copy_video(args)
     
     def process_file(self, args):
-        """处理单个文件"""
-        # 初始化子进程日志
-        input_dir = args[1]  # 从args获取输入目录
-        log_file = Path(input_dir) / "video_compress.log"
-        setup_logging(log_file)
-        
-        # 获取当前可用的ffmpeg命令
-        ffmpeg_cmd = get_ffmpeg_command()
-        logI(f"使用ffmpeg命令: {ffmpeg_cmd}")
-        return process_video(args)
+        """处理单个文件，批量任务返回结果列表 (在父进程的线程中运行，日志已由 main 初始化)"""
+        logI(f"使用ffmpeg命令: {self.ffmpeg_cmd}")
+        if isinstance(args, list):
+            return process_video_batch(args, self.ffmpeg_cmd)
+        return process_video(args, self.ffmpeg_cmd)
 
 
 def main():
@@ -332,6 +716,8 @@ def main():
                       help="FFmpeg preset (e.g. ultrafast, superfast, veryfast, faster, fast, medium, slow, slower, veryslow)")
     parser.add_argument("-s", "--software", action="store_true",
                       help="Force software encoding (disable hardware acceleration)")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                      help="Log every processed file (default: throttle progress lines)")
     
     args = parser.parse_args()
     
@@ -345,7 +731,7 @@ def main():
     log_file = Path(input_dir) / "video_compress.log"
     setup_logging(log_file)
     logI(f"开始视频压缩: {input_dir}")
-    logI(f"目标比特率: {args.bitrate or '1M (default)'}")
+    logI(f"目标比特率: {args.bitrate or '未指定 (硬件编码按原始码率 ×0.6，上限 4M；其他为 1M)'}")
     logI(f"CRF参数: {args.crf or '未使用'}")
     logI(f"工作进程数: {args.workers}")
     logI(f"强制软件编码: {'是' if args.software else '否'}")
@@ -360,7 +746,8 @@ def main():
             crf=args.crf,
             preset=args.preset,
             workers=args.workers,
-            use_software=args.software
+            use_software=args.software,
+            verbose=args.verbose
         )
         
         success = compressor.process()
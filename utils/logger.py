@@ -1,28 +1,61 @@
+import atexit
 import logging
+import multiprocessing
+import queue
+from logging.handlers import QueueHandler, QueueListener
 
 __logger: logging.Logger = None
+__handlers: list = None
+__worker_queue = None
 
 def setup_logging(file: str):
-    """配置日志记录"""
-    global __logger  # Ensure the global variable is updated
+    """配置日志记录 (调用方只把记录放入队列，由父进程的监听线程写文件和终端)"""
+    global __handlers  # Ensure the global variable is updated
     print(f"zoudao日志文件: {file}")
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(message)s",
-        handlers=[
-            logging.FileHandler(file, encoding='utf-8'),
-            logging.StreamHandler()
-        ]
-    )
+    if __logger is not None:
+        # 已初始化 (包括 fork 出的工作进程继承的配置)，与 basicConfig 一样不重复配置
+        return
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+    __handlers = [
+        logging.FileHandler(file, encoding='utf-8'),
+        logging.StreamHandler()
+    ]
+    for handler in __handlers:
+        handler.setFormatter(formatter)
+    # 父进程的日志走进程内队列，无需序列化
+    log_queue = queue.Queue(-1)
+    setup_queue_logging(log_queue)
+    _start_listener(log_queue)
+
+def _start_listener(log_queue):
+    """启动把 log_queue 中的记录写到文件和终端的监听线程"""
+    listener = QueueListener(log_queue, *__handlers)
+    listener.start()
+    # 退出前写完队列中剩余的记录
+    atexit.register(listener.stop)
+
+def get_log_queue():
+    """返回供工作进程使用的进程间日志队列 (首次调用时创建并启动监听线程)，未初始化时返回 None"""
+    global __worker_queue
+    if __handlers is None:
+        return None
+    if __worker_queue is None:
+        # spawn 上下文创建的队列可传给任意启动方式的工作进程，fork 上下文的不能传给 forkserver
+        __worker_queue = multiprocessing.get_context("spawn").Queue(-1)
+        _start_listener(__worker_queue)
+    return __worker_queue
+
+def setup_queue_logging(log_queue):
+    """把日志记录发送到 log_queue，替换已有的队列 (fork 出的工作进程继承的是父进程的进程内队列)"""
+    global __logger
     __logger = logging.getLogger()
+    __logger.setLevel(logging.INFO)
+    for handler in [h for h in __logger.handlers if isinstance(h, QueueHandler)]:
+        __logger.removeHandler(handler)
+    __logger.addHandler(QueueHandler(log_queue))
 
 def logI(msg: str, flush: bool = False):
-    """记录信息级别日志"""
+    """记录信息级别日志 (flush 参数仅为兼容保留，监听线程负责写出)"""
     if __logger is None:
         raise RuntimeError("Logger is not initialized. Call setup_logging() first.")
     __logger.info(msg)
-    if flush:
-        for handler in __logger.handlers:
-            handler.flush()
-
-
@@ -0,0 +1,34 @@
+import sqlite3
+
+
+class MetadataCache:
+    """基于 sqlite 的媒体元数据缓存，以文件路径为键，文件大小或修改时间变化时视为失效"""
+
+    def __init__(self, db_file: str):
+        # 自动提交 + WAL 模式，多个工作进程可同时读写
+        self.conn = sqlite3.connect(str(db_file), isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            "path TEXT PRIMARY KEY, size INT, mtime REAL, bitrate INT)"
+        )
+
+    def get_bitrate(self, path: str, size: int, mtime: float):
+        """读取缓存的码率，未命中或已失效时返回 None"""
+        row = self.conn.execute(
+            "SELECT size, mtime, bitrate FROM metadata WHERE path = ?", (str(path),)
+        ).fetchone()
+        if row and row[0] == size and row[1] == mtime:
+            return row[2]
+        return None
+
+    def set_bitrate(self, path: str, size: int, mtime: float, bitrate: int):
+        """写入码率"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)",
+            (str(path), size, mtime, bitrate)
+        )
+
+    def close(self):
+        """关闭数据库连接"""
+        self.conn.close()